@@ -1,4 +1,222 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+import hashlib
+import threading
+
+import torch
+from torchao.quantization import Int8WeightOnlyConfig
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    CompileConfig,
+    StaticCache,
+    TorchAoConfig,
+)
+
+# Number of tokens (system prompt + history + reply) a session's cache can hold
+MAX_CACHE_LEN = 4096
+
+# Default reply length limit; generation stops earlier at the end of the turn
+DEFAULT_MAX_NEW_TOKENS = 512
+
+# Context length above which a session's cache is compacted after a turn,
+# leaving room for another message and a default-length reply
+COMPACT_THRESHOLD = MAX_CACHE_LEN - 2 * DEFAULT_MAX_NEW_TOKENS
+
+# Most tokens of recent turns kept, after the system prompt, when compacting
+COMPACT_KEEP_LEN = MAX_CACHE_LEN // 2
+
+
+class ModelRuntime:
+    """
+    Holds the language model and tokenizer shared by all chat sessions.
+    The weights are loaded once; each ChatState only keeps its own history and KV cache.
+    """
+
+    def __init__(self, model_name, quantize=True):
+        """
+        Loads the model and tokenizer.
+
+        Args:
+            model_name: The language model to use for generating responses.
+            quantize: (Optional) Load int8 weight-only quantized weights.
+        """
+        self.model_name = model_name
+
+        # Decoding re-reads every weight per token, so int8 weights roughly
+        # halve the memory traffic; torchao's kernels also work with compile
+        quantization_config = None
+        if quantize:
+            quantization_config = TorchAoConfig(Int8WeightOnlyConfig())
+
+        # Load model and tokenizer
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype="auto",
+            device_map="auto",
+            # PyTorch's fused SDPA kernels; FlashAttention would force graph
+            # breaks in the compiled static-cache decode
+            attn_implementation="sdpa",
+            quantization_config=quantization_config,
+        )
+        self.device = next(self.model.parameters()).device
+
+        # Static-cache decoding is compiled by generate(); CUDA graphs remove
+        # the per-step Python and kernel launch overhead
+        if self.device.type == "cuda":
+            self.model.generation_config.compile_config = CompileConfig(
+                fullgraph=True, mode="reduce-overhead"
+            )
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        # Tokens that end a model turn (e.g. <eos>, <end_of_turn>)
+        eos_token_id = self.model.generation_config.eos_token_id
+        if not isinstance(eos_token_id, list):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id)
+
+        # Prefilled system prompt caches shared by all sessions, keyed by the prompt hash
+        self._system_prefix_caches = {}
+
+        # Every generate() call runs against this one cache, so the compiled
+        # decode step and its CUDA graphs always see the same static buffers.
+        # Sessions keep their own caches and are swapped in by copying.
+        self._decode_cache = self.new_cache()
+        # The session cache whose contents the decode cache currently holds
+        self._decode_cache_owner = None
+
+        # Pinned host buffer that new token ids are staged in, so their copy
+        # to the GPU is asynchronous instead of a synchronizing pageable copy
+        self._staging = None
+        if self.device.type == "cuda":
+            self._staging = torch.empty(
+                MAX_CACHE_LEN, dtype=torch.long, pin_memory=True
+            )
+            self._staging_copied = torch.cuda.Event()
+            self._staging_lock = threading.Lock()
+
+        self._warmup()
+
+    def _warmup(self):
+        """
+        Runs a tiny generation so torch.compile happens at startup rather than
+        on the first user request.
+        """
+        self.model.generate(
+            input_ids=self.tokenize("<start_of_turn>user\n", add_special_tokens=True),
+            past_key_values=self._decode_cache,
+            max_new_tokens=2,
+        )
+        self._decode_cache.reset()
+
+    def new_cache(self):
+        """
+        Allocates an empty KV cache for one conversation.
+        Its buffers are allocated here at full size, rather than on first use,
+        so their shapes and addresses stay fixed.
+        """
+        config = self.model.config.get_text_config(decoder=True)
+        head_dim = getattr(config, "head_dim", None) or (
+            config.hidden_size // config.num_attention_heads
+        )
+        cache = StaticCache(config=self.model.config, max_cache_len=MAX_CACHE_LEN)
+        cache.early_initialization(
+            batch_size=1,
+            num_heads=config.num_key_value_heads,
+            head_dim=head_dim,
+            dtype=self.model.dtype,
+            device=self.device,
+        )
+        return cache
+
+    def get_system_prefix(self, system, past_kv=None):
+        """
+        Returns the token ids of a system prompt and a KV cache already holding
+        them. The prompt is prefilled once; every call returns a copy of that
+        cache, so sessions with the same system prompt skip its prefill.
+
+        Args:
+            system: The system prompt.
+            past_kv: (Optional) A session cache to refill in place with the
+                prefix, instead of allocating a new one.
+        """
+        key = hashlib.sha256(system.encode()).hexdigest()
+        if key not in self._system_prefix_caches:
+            # The system prompt (and <bos>) starts the token stream of every session
+            prefix = system + "\n" if len(system) > 0 else ""
+            input_ids = self.tokenize(prefix, add_special_tokens=True)
+            prefix_kv = self.new_cache()
+            with torch.no_grad():
+                self.model(
+                    input_ids=input_ids, past_key_values=prefix_kv, use_cache=True
+                )
+
+            self._system_prefix_caches[key] = (input_ids, prefix_kv)
+
+        input_ids, prefix_kv = self._system_prefix_caches[key]
+        if past_kv is None:
+            past_kv = self.new_cache()
+        else:
+            # The session's contents are replaced, so a stale copy of them in
+            # the decode cache must not be written back later
+            self.release_decode_cache(past_kv)
+        copy_cache(past_kv, prefix_kv)
+        return input_ids.clone(), past_kv
+
+    def load_decode_cache(self, past_kv):
+        """
+        Loads a session cache into the decode cache and returns the decode cache.
+        The previous session's state is written back to its own cache first.
+        Nothing is copied while the same session keeps generating.
+        """
+        if self._decode_cache_owner is not past_kv:
+            if self._decode_cache_owner is not None:
+                copy_cache(self._decode_cache_owner, self._decode_cache)
+            copy_cache(self._decode_cache, past_kv)
+            self._decode_cache_owner = past_kv
+        return self._decode_cache
+
+    def release_decode_cache(self, past_kv):
+        """
+        Drops the decode cache's copy of a session cache without writing it
+        back, e.g. because the session cache is about to be refilled.
+        """
+        if self._decode_cache_owner is past_kv:
+            self._decode_cache_owner = None
+
+    def tokenize(self, text, add_special_tokens):
+        """
+        Tokenizes text into a (1, seq_len) tensor on the model's device.
+        """
+        input_ids = self.tokenizer(
+            text, return_tensors="pt", add_special_tokens=add_special_tokens
+        ).input_ids
+        if self._staging is None or input_ids.shape[1] > len(self._staging):
+            return input_ids.to(self.device)
+
+        with self._staging_lock:
+            # The previous copy out of the buffer must finish before it is reused
+            self._staging_copied.synchronize()
+            staged = self._staging[: input_ids.shape[1]]
+            staged.copy_(input_ids[0])
+            device_ids = staged.unsqueeze(0).to(self.device, non_blocking=True)
+            self._staging_copied.record()
+        return device_ids
+
+
+def copy_cache(dst, src):
+    """
+    Copies the contents of one cache from new_cache() into another in place,
+    so dst keeps its buffers (and their addresses).
+    """
+    for dst_layer, src_layer in zip(dst.layers, src.layers):
+        # Besides keys and values, layers track how much they hold in tensors
+        # or plain ints whose names differ between transformers versions, so
+        # every tensor and number in the layer's state is copied
+        for name, value in vars(src_layer).items():
+            if isinstance(value, torch.Tensor):
+                getattr(dst_layer, name).copy_(value)
+            elif isinstance(value, int):
+                setattr(dst_layer, name, value)
 
 
 class ChatState:
@@ -12,77 +230,242 @@ class ChatState:
     __START_TURN_MODEL__ = "<start_of_turn>model\n"
     __END_TURN__ = "<end_of_turn>\n"
 
-    def __init__(self, model_name, system=""):
+    def __init__(self, runtime, system=""):
         """
         Initializes the chat state.
 
         Args:
-            model: The language model to use for generating responses.
+            runtime: The shared ModelRuntime used for generating responses.
             system: (Optional) System instructions or bot description.
         """
-        self.model_name = model_name
+        self.runtime = runtime
         self.system = system
+        # (role, content) pairs, role being "user" or "assistant"
         self.history = []
+        # The history formatted with turn markers, extended as turns are added
+        self._history_str = ""
+        # Where the turns still in the model's context start in _history_str
+        self._context_offset = 0
+        # (token index, _history_str length) at the start of every user turn
+        # still in the model's context, where compaction can cut
+        self._turn_starts = []
 
-        # Load model and tokenizer
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype="auto",
-            device_map="auto",
-            attn_implementation="eager",
-        )
-
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.pipe = pipeline(
-            "text-generation", model=self.model, tokenizer=self.tokenizer
-        )
+        # KV cache kept across turns, so each turn only prefills its new tokens.
+        # generate() needs the full token sequence to work out which positions
+        # are already cached, so it is kept alongside the cache. Both start from
+        # the shared, already prefilled system prompt.
+        self.input_ids, self.past_kv = runtime.get_system_prefix(system)
 
     def add_to_history_as_user(self, message):
         """
-        Adds a user message to the history with start/end turn markers.
+        Adds a user message to the history.
         """
-        self.history.append(self.__START_TURN_USER__ + message + self.__END_TURN__)
+        self.history.append(("user", message))
+        self._history_str += self.__START_TURN_USER__ + message + self.__END_TURN__
 
     def add_to_history_as_model(self, message):
         """
-        Adds a model response to the history with start/end turn markers.
+        Adds a model response to the history.
         """
-        self.history.append(self.__START_TURN_MODEL__ + message + self.__END_TURN__)
+        self.history.append(("assistant", message))
+        self._history_str += self.__START_TURN_MODEL__ + message + self.__END_TURN__
 
     def get_history(self):
         """
-        Returns the entire chat history as a single string.
+        Returns the entire chat history as a single string, with start/end turn markers.
         """
-        return "".join([*self.history])
+        return self._history_str
 
     def get_full_prompt(self):
         """
         Builds the prompt for the language model, including history and system description.
+        Turns dropped from the model's context by compact() are left out.
         """
-        prompt = self.get_history() + self.__START_TURN_MODEL__
+        prompt = self._history_str[self._context_offset :] + self.__START_TURN_MODEL__
         if len(self.system) > 0:
             prompt = self.system + "\n" + prompt
         return prompt
 
-    def send_message(self, message):
+    def send_message(self, message, max_new_tokens=DEFAULT_MAX_NEW_TOKENS):
         """
         Handles sending a user message and getting a model response.
 
         Args:
             message: The user's message.
+            max_new_tokens: (Optional) Maximum length of the response in tokens.
 
         Returns:
             The model's response.
         """
+        self.start_turn(message, max_new_tokens)
+        while not self.generate_step():
+            pass
+        return self.finish_turn()
+
+    def start_turn(self, message, max_new_tokens=DEFAULT_MAX_NEW_TOKENS):
+        """
+        Adds a user message and appends its turn to the token stream.
+        The reply is then produced by generate_step() and finish_turn().
+
+        Args:
+            message: The user's message.
+            max_new_tokens: (Optional) Maximum length of the reply in tokens.
+        """
+        # Only the new turn is tokenized; earlier tokens are kept in input_ids
+        new_turn = (
+            self.__START_TURN_USER__
+            + message
+            + self.__END_TURN__
+            + self.__START_TURN_MODEL__
+        )
+        new_ids = self.runtime.tokenize(new_turn, add_special_tokens=False)
+
+        # Checked before anything is changed, so a rejected message leaves the
+        # conversation as it was
+        if self.input_ids.shape[1] + new_ids.shape[1] >= MAX_CACHE_LEN:
+            raise ValueError(
+                f"Conversation exceeds the maximum context of {MAX_CACHE_LEN} tokens"
+            )
+
+        self._turn_starts.append((self.input_ids.shape[1], len(self._history_str)))
         self.add_to_history_as_user(message)
-        prompt = self.get_full_prompt()
-        response = self.pipe(prompt, max_new_tokens=2048, disable_compile=True)
-        result = response[0]["generated_text"][len(prompt) :].strip()
+        self.input_ids = torch.cat([self.input_ids, new_ids], dim=-1)
+
+        if max_new_tokens is None:
+            max_new_tokens = DEFAULT_MAX_NEW_TOKENS
+        self._reply_start = self.input_ids.shape[1]
+        self._reply_end = min(self._reply_start + max_new_tokens, MAX_CACHE_LEN)
+
+    def generate_step(self, max_new_tokens=None, streamer=None):
+        """
+        Generates more tokens of the current reply, continuing from the cache.
+
+        Args:
+            max_new_tokens: (Optional) Tokens to generate in this step; by
+                default the reply is generated to the end.
+            streamer: (Optional) A transformers streamer receiving the new tokens.
+
+        Returns:
+            True once the reply is complete.
+        """
+        budget = self._reply_end - self.input_ids.shape[1]
+        if max_new_tokens is not None:
+            budget = min(budget, max_new_tokens)
+
+        out = self.runtime.model.generate(
+            input_ids=self.input_ids,
+            past_key_values=self.runtime.load_decode_cache(self.past_kv),
+            use_cache=True,
+            max_new_tokens=budget,
+            eos_token_id=list(self.runtime.eos_token_ids),
+            pad_token_id=self.runtime.tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            streamer=streamer,
+        )
+        self.input_ids = out.sequences
+
+        return (
+            self.input_ids[0, -1].item() in self.runtime.eos_token_ids
+            or self.input_ids.shape[1] >= self._reply_end
+        )
+
+    def finish_turn(self):
+        """
+        Closes the model turn and adds the reply to the history.
+
+        Returns:
+            The model's response.
+        """
+        generated = self.input_ids[0, self._reply_start :]
+        result = self.runtime.tokenizer.decode(
+            generated, skip_special_tokens=True
+        ).strip()
+
+        # Close the model turn in the token stream the same way as in the history
+        if self.input_ids[0, -1].item() in self.runtime.eos_token_ids:
+            self.input_ids = self.input_ids[:, :-1]
+        self.input_ids = torch.cat(
+            [
+                self.input_ids,
+                self.runtime.tokenize(self.__END_TURN__, add_special_tokens=False),
+            ],
+            dim=-1,
+        )
+
         self.add_to_history_as_model(result)
+
+        if self.input_ids.shape[1] > COMPACT_THRESHOLD:
+            self.compact()
+
         return result
 
+    def compact(self, keep_len=COMPACT_KEEP_LEN):
+        """
+        Shrinks the model's context for long conversations: the system prompt
+        and the most recent whole turns that fit in keep_len tokens are kept,
+        older turns are dropped. The history shown to the user is not affected.
+
+        Args:
+            keep_len: (Optional) Most tokens of recent turns to keep.
+        """
+        total_len = self.input_ids.shape[1]
+        kept = [turn for turn in self._turn_starts if total_len - turn[0] <= keep_len]
+        if kept:
+            cut, self._context_offset = kept[0]
+        else:
+            cut, self._context_offset = total_len, len(self._history_str)
+        tail = self.input_ids[:, cut:]
+
+        # Start again from the shared system prompt cache; the kept turns are
+        # prefilled at their new positions on the next turn
+        self.input_ids, _ = self.runtime.get_system_prefix(self.system, self.past_kv)
+        shift = cut - self.input_ids.shape[1]
+        self._turn_starts = [(start - shift, offset) for start, offset in kept]
+        self.input_ids = torch.cat([self.input_ids, tail], dim=-1)
+
+    def checkpoint(self):
+        """
+        Returns a snapshot of the conversation that restore() can go back to.
+        """
+        return (
+            self.input_ids,
+            len(self.history),
+            len(self._history_str),
+            self._context_offset,
+            list(self._turn_starts),
+        )
+
+    def restore(self, checkpoint):
+        """
+        Goes back to a checkpoint(), e.g. after a turn failed part way through.
+        The cache may already hold later tokens, so it is refilled with the
+        system prompt and the rest is prefilled again on the next turn.
+
+        Args:
+            checkpoint: A snapshot returned by checkpoint().
+        """
+        input_ids, history_len, history_str_len, context_offset, turn_starts = (
+            checkpoint
+        )
+        del self.history[history_len:]
+        self._history_str = self._history_str[:history_str_len]
+        self._context_offset = context_offset
+        self._turn_starts = turn_starts
+        self.runtime.get_system_prefix(self.system, self.past_kv)
+        self.input_ids = input_ids
+
+    def reset(self):
+        """
+        Clears the conversation, going back to just the system prompt.
+        """
+        self.history.clear()
+        self._history_str = ""
+        self._context_offset = 0
+        self._turn_starts.clear()
+        self.input_ids, _ = self.runtime.get_system_prefix(self.system, self.past_kv)
+
 
 if __name__ == "__main__":
-    chat = ChatState("google/gemma-3-270m-it")
+    chat = ChatState(ModelRuntime("google/gemma-3-270m-it"))
     message = "Tell me, in a few words,  how to compute all prime numbers up to 1000?"
     print(chat.send_message(message))
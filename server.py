@@ -1,21 +1,27 @@
 import asyncio
+import json
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
 
-from app import ChatState
+from app import DEFAULT_MAX_NEW_TOKENS, ChatState, ModelRuntime
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from transformers import TextStreamer
 
 
 class ChatMessage(BaseModel):
     message: str
     session_id: Optional[str] = None
+    max_new_tokens: Optional[int] = Field(default=DEFAULT_MAX_NEW_TOKENS, ge=1)
 
 
 class ChatResponse(BaseModel):
@@ -30,41 +36,170 @@ class ChatHistory(BaseModel):
     session_id: str
 
 
+class ReplyStreamer(TextStreamer):
+    """Forwards reply text decoded on the inference thread to an asyncio queue"""
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.text_queue: asyncio.Queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self.text_queue.put_nowait, text)
+
+
+@dataclass
+class GenerationRequest:
+    """A chat message waiting for, or being given, a model reply"""
+
+    chat_state: ChatState
+    message: str
+    max_new_tokens: Optional[int]
+    future: asyncio.Future
+    streamer: Optional[ReplyStreamer] = None
+    started: bool = field(default=False, init=False)
+    checkpoint: Optional[tuple] = field(default=None, init=False)
+
+    def step(self) -> Optional[str]:
+        """Run one scheduling round; returns the reply once it is complete"""
+        if not self.started:
+            self.checkpoint = self.chat_state.checkpoint()
+            self.chat_state.start_turn(self.message, self.max_new_tokens)
+            self.started = True
+        try:
+            if self.chat_state.generate_step(
+                max_new_tokens=DECODE_CHUNK_TOKENS, streamer=self.streamer
+            ):
+                return self.chat_state.finish_turn()
+            return None
+        except Exception:
+            # Drop the failed turn, so the session is not left with a partial
+            # reply and an unanswered message
+            self.chat_state.restore(self.checkpoint)
+            raise
+
+
+@dataclass
+class ResetRequest:
+    """A session to clear once no reply is being generated for it"""
+
+    chat_state: ChatState
+    future: asyncio.Future
+
+    def step(self) -> Optional[str]:
+        """Clear the session; this always completes in one round"""
+        self.chat_state.reset()
+        return ""
+
+
 # Store chat sessions in memory (in production, use Redis or a database)
 chat_sessions: Dict[str, ChatState] = {}
-session_timestamps: Dict[str, datetime] = {}
+# Last activity of each session, least recently active first
+session_lru: "OrderedDict[str, datetime]" = OrderedDict()
+# Guards chat_sessions and session_lru against the cleanup task
+session_lock = asyncio.Lock()
 
 # Session timeout (in hours)
 SESSION_TIMEOUT_HOURS = 2
 
+# Requests generating at the same time; further requests wait in the queue
+MAX_ACTIVE_REQUESTS = 8
+
+# Tokens generated for one request before the worker moves on to the next one
+DECODE_CHUNK_TOKENS = 32
+
+MODEL_NAME = "google/gemma-3-270m-it"
+
+# Shared by every session, so its KV cache is computed only once
+SYSTEM_PROMPT = """You are a helpful, friendly AI assistant.
+    You provide clear, concise, and accurate responses to user queries.
+    Be engaging and maintain context throughout the conversation."""
+
 
 async def cleanup_old_sessions():
     """Remove sessions that have been inactive for too long"""
     while True:
         current_time = datetime.now()
-        sessions_to_remove = []
+        timeout = timedelta(hours=SESSION_TIMEOUT_HOURS)
+        removed = 0
+
+        # Only the expired sessions at the front of the LRU order are visited
+        async with session_lock:
+            while (
+                session_lru
+                and current_time - next(iter(session_lru.values())) > timeout
+            ):
+                session_id, _ = session_lru.popitem(last=False)
+                chat_sessions.pop(session_id, None)
+                removed += 1
+
+        if removed:
+            print(f"Cleaned up {removed} expired sessions")
 
-        for session_id, last_activity in session_timestamps.items():
-            if current_time - last_activity > timedelta(hours=SESSION_TIMEOUT_HOURS):
-                sessions_to_remove.append(session_id)
+        # Run cleanup every 30 minutes
+        await asyncio.sleep(1800)
 
-        for session_id in sessions_to_remove:
-            if session_id in chat_sessions:
-                del chat_sessions[session_id]
-            if session_id in session_timestamps:
-                del session_timestamps[session_id]
 
-        if sessions_to_remove:
-            print(f"Cleaned up {len(sessions_to_remove)} expired sessions")
+async def batch_worker(queue: asyncio.Queue, executor: ThreadPoolExecutor):
+    """
+    Owns the model and schedules generation (and session resets) across sessions.
+    Each round runs one chunk of every active request, so a new request's
+    prefill and a short reply are not held back by a long reply in progress.
+    """
+    loop = asyncio.get_running_loop()
+    pending: List[Union[GenerationRequest, ResetRequest]] = []
+    active: List[Union[GenerationRequest, ResetRequest]] = []
 
-        # Run cleanup every 30 minutes
-        await asyncio.sleep(1800)
+    while True:
+        if not active and not pending:
+            pending.append(await queue.get())
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+
+        # Admit waiting requests, but only one at a time per session
+        busy = {request.chat_state for request in active}
+        for request in list(pending):
+            if len(active) >= MAX_ACTIVE_REQUESTS:
+                break
+            if request.chat_state not in busy:
+                pending.remove(request)
+                active.append(request)
+                busy.add(request.chat_state)
+
+        still_active = []
+        for request in active:
+            try:
+                reply = await loop.run_in_executor(executor, request.step)
+            except Exception as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                continue
+
+            if reply is None:
+                still_active.append(request)
+            elif not request.future.done():
+                request.future.set_result(reply)
+        active = still_active
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("Starting up chatbot server...")
+    # Load the model once for all sessions and prefill the system prompt
+    app.state.runtime = ModelRuntime(model_name=MODEL_NAME)
+    app.state.runtime.get_system_prefix(SYSTEM_PROMPT)
+    # Inference runs off the event loop; a single worker feeds the GPU one
+    # request at a time
+    app.state.inference_executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="inference"
+    )
+    # Chat requests are queued for the task that schedules generation
+    app.state.request_queue = asyncio.Queue()
+    worker_task = asyncio.create_task(
+        batch_worker(app.state.request_queue, app.state.inference_executor)
+    )
     # Create a task for periodic cleanup
     cleanup_task = asyncio.create_task(cleanup_old_sessions())
 
@@ -72,11 +207,13 @@ async def lifespan(app: FastAPI):
 
     # Shutdown
     print("Shutting down chatbot server...")
-    cleanup_task.cancel()
-    try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+    for task in (cleanup_task, worker_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    app.state.inference_executor.shutdown(wait=False, cancel_futures=True)
 
 
 # Create FastAPI app with lifespan manager
@@ -103,25 +240,31 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 
-def get_or_create_session(session_id: Optional[str] = None) -> tuple[str, ChatState]:
-    """Get existing session or create a new one"""
-    if session_id and session_id in chat_sessions:
-        # Update last activity timestamp
-        session_timestamps[session_id] = datetime.now()
-        return session_id, chat_sessions[session_id]
-
-    # Create new session
-    new_session_id = str(uuid.uuid4())
-    system_prompt = """You are a helpful, friendly AI assistant.
-    You provide clear, concise, and accurate responses to user queries.
-    Be engaging and maintain context throughout the conversation."""
+def touch_session(session_id: str):
+    """Record activity on a session, moving it to the back of the LRU order"""
+    session_lru[session_id] = datetime.now()
+    session_lru.move_to_end(session_id)
 
-    chat_sessions[new_session_id] = ChatState(
-        model_name="google/gemma-3-270m-it", system=system_prompt
-    )
-    session_timestamps[new_session_id] = datetime.now()
 
-    return new_session_id, chat_sessions[new_session_id]
+async def get_or_create_session(
+    session_id: Optional[str] = None,
+) -> tuple[str, ChatState]:
+    """Get existing session or create a new one"""
+    async with session_lock:
+        chat_state = chat_sessions.get(session_id) if session_id else None
+        if chat_state is not None:
+            # Update last activity timestamp
+            touch_session(session_id)
+            return session_id, chat_state
+
+        # Create new session
+        new_session_id = uuid.uuid4().hex
+        chat_sessions[new_session_id] = ChatState(
+            app.state.runtime, system=SYSTEM_PROMPT
+        )
+        touch_session(new_session_id)
+
+        return new_session_id, chat_sessions[new_session_id]
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -137,10 +280,16 @@ async def chat(chat_message: ChatMessage):
     """
     try:
         # Get or create session
-        session_id, chat_state = get_or_create_session(chat_message.session_id)
+        session_id, chat_state = await get_or_create_session(chat_message.session_id)
 
-        # Generate response
-        response = chat_state.send_message(chat_message.message)
+        # Queue the message for the generation worker and wait for its reply
+        future = asyncio.get_running_loop().create_future()
+        await app.state.request_queue.put(
+            GenerationRequest(
+                chat_state, chat_message.message, chat_message.max_new_tokens, future
+            )
+        )
+        response = await future
 
         # Get the last prompt that was sent to the LLM
         last_prompt = chat_state.get_full_prompt()
@@ -157,6 +306,57 @@ async def chat(chat_message: ChatMessage):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(chat_message: ChatMessage):
+    """
+    Process a chat message and stream the AI response as server-sent events.
+    "token" events carry reply text as it is generated; a final "done" event
+    carries the same fields as /api/chat.
+    """
+    session_id, chat_state = await get_or_create_session(chat_message.session_id)
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    streamer = ReplyStreamer(app.state.runtime.tokenizer, loop)
+    # Text reaches the queue before the reply completes, so None marks the end
+    future.add_done_callback(lambda _: streamer.text_queue.put_nowait(None))
+    await app.state.request_queue.put(
+        GenerationRequest(
+            chat_state,
+            chat_message.message,
+            chat_message.max_new_tokens,
+            future,
+            streamer,
+        )
+    )
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    async def events():
+        while (text := await streamer.text_queue.get()) is not None:
+            yield sse("token", {"token": text})
+
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"Error in chat stream endpoint: {str(e)}")
+            yield sse("error", {"detail": str(e)})
+            return
+
+        yield sse(
+            "done",
+            ChatResponse(
+                response=response,
+                session_id=session_id,
+                timestamp=datetime.now().isoformat(),
+                last_prompt=chat_state.get_full_prompt(),
+            ).model_dump(),
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @app.get("/api/history/{session_id}", response_model=ChatHistory)
 async def get_history(session_id: str):
     """
@@ -166,19 +366,9 @@ async def get_history(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
 
     chat_state = chat_sessions[session_id]
-    history = chat_state.history
-
-    # Parse history into structured format
-    messages = []
-    for item in history:
-        if item.startswith(ChatState.__START_TURN_USER__):
-            content = item.replace(ChatState.__START_TURN_USER__, "").replace(
-                ChatState.__END_TURN__, ""
-            )
-            messages.append({"role": "user", "content": content})
-        elif item.startswith(ChatState.__START_TURN_MODEL__):
-            content = item.replace(ChatState.__START_TURN_MODEL__, "")
-            messages.append({"role": "assistant", "content": content})
+    messages = [
+        {"role": role, "content": content} for role, content in chat_state.history
+    ]
 
     return ChatHistory(messages=messages, session_id=session_id)
 
@@ -188,18 +378,18 @@ async def clear_session(session_id: str):
     """
     Clear the chat history for a specific session
     """
-    if session_id not in chat_sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+    async with session_lock:
+        if session_id not in chat_sessions:
+            raise HTTPException(status_code=404, detail="Session not found")
 
-    # Recreate the session with fresh state
-    system_prompt = """You are a helpful, friendly AI assistant.
-    You provide clear, concise, and accurate responses to user queries.
-    Be engaging and maintain context throughout the conversation."""
+        chat_state = chat_sessions[session_id]
+        touch_session(session_id)
 
-    chat_sessions[session_id] = ChatState(
-        model_name="google/gemma-3-270m-it", system=system_prompt
-    )
-    session_timestamps[session_id] = datetime.now()
+    # Reset the session in place, through the generation worker so that it
+    # cannot interleave with a reply being generated for this session
+    future = asyncio.get_running_loop().create_future()
+    await app.state.request_queue.put(ResetRequest(chat_state, future))
+    await future
 
     return {"message": "Session cleared successfully", "session_id": session_id}
 
@@ -209,7 +399,7 @@ async def get_active_sessions():
     """Get the count of active sessions (for monitoring)"""
     return {
         "active_sessions": len(chat_sessions),
-        "total_sessions_created": len(session_timestamps),
+        "total_sessions_created": len(session_lru),
     }
 
 
@@ -87,6 +87,9 @@ async function sendMessage() {
 
   if (!message || isTyping) return;
 
+  let userMessage = null;
+  let assistantMessage = null;
+
   try {
     isTyping = true;
     sendButton.disabled = true;
@@ -98,7 +101,7 @@ async function sendMessage() {
     }
 
     // Add user message to chat
-    addMessageToChat("user", message);
+    userMessage = addMessageToChat("user", message);
 
     // Clear input
     messageInput.value = "";
@@ -109,8 +112,8 @@ async function sendMessage() {
     // Show typing indicator
     showTypingIndicator();
 
-    // Send request to API
-    const response = await fetch("/api/chat", {
+    // Send request to API and stream the response as it is generated
+    const response = await fetch("/api/chat/stream", {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -125,7 +128,17 @@ async function sendMessage() {
       throw new Error(`HTTP error! status: ${response.status}`);
     }
 
-    const data = await response.json();
+    let streamedText = "";
+    const data = await readEventStream(response, (token) => {
+      streamedText += token;
+      if (!assistantMessage) {
+        // Replace the typing indicator with the response on the first token
+        removeTypingIndicator();
+        assistantMessage = addMessageToChat("assistant", streamedText);
+      } else {
+        updateMessageContent(assistantMessage, streamedText);
+      }
+    });
 
     // Update session ID if new
     if (!sessionId || sessionId !== data.session_id) {
@@ -137,8 +150,12 @@ async function sendMessage() {
     // Remove typing indicator
     removeTypingIndicator();
 
-    // Add AI response to chat
-    addMessageToChat("assistant", data.response, data.timestamp);
+    // Show the final AI response in the chat
+    if (assistantMessage) {
+      updateMessageContent(assistantMessage, data.response, data.timestamp);
+    } else {
+      addMessageToChat("assistant", data.response, data.timestamp);
+    }
 
     // Update debug panel with the last prompt if available
     if (data.last_prompt) {
@@ -153,6 +170,22 @@ async function sendMessage() {
   } catch (error) {
     console.error("Error sending message:", error);
     removeTypingIndicator();
+
+    // The server drops a failed turn, so remove it from the chat as well,
+    // including any partly streamed reply, and give the message back to retry
+    if (assistantMessage) {
+      assistantMessage.remove();
+    }
+    if (userMessage) {
+      userMessage.remove();
+    }
+    if (!messageInput.value) {
+      messageInput.value = message;
+      updateCharCount();
+      adjustTextareaHeight();
+      validateInput();
+    }
+
     showError("Failed to send message. Please try again.");
   } finally {
     isTyping = false;
@@ -160,6 +193,48 @@ async function sendMessage() {
   }
 }
 
+// Read server-sent events from a streaming chat response.
+// Calls onToken for each piece of text and resolves with the final response data.
+async function readEventStream(response, onToken) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      rawEvent.split("\n").forEach((line) => {
+        if (line.startsWith("event: ")) {
+          event = line.slice(7);
+        } else if (line.startsWith("data: ")) {
+          data += line.slice(6);
+        }
+      });
+
+      const payload = JSON.parse(data);
+      if (event === "token") {
+        onToken(payload.token);
+      } else if (event === "done") {
+        return payload;
+      } else if (event === "error") {
+        throw new Error(payload.detail);
+      }
+    }
+  }
+
+  throw new Error("Response stream ended unexpectedly");
+}
+
 // Add message to chat display
 function addMessageToChat(role, content, timestamp = null) {
   const messageDiv = document.createElement("div");
@@ -168,14 +243,22 @@ function addMessageToChat(role, content, timestamp = null) {
         <div class="message-avatar">
             <i class="fas fa-${role === "user" ? "user" : "robot"}"></i>
         </div>
-        <div class="message-content">
-            ${formatMessage(content)}
-            ${timestamp ? `<div class="message-timestamp">${formatTimestamp(timestamp)}</div>` : ""}
-        </div>
+        <div class="message-content"></div>
     `;
+  updateMessageContent(messageDiv, content, timestamp);
 
   chatContainer.appendChild(messageDiv);
   scrollToBottom();
+  return messageDiv;
+}
+
+// Replace the content of a message already in the chat display
+function updateMessageContent(messageDiv, content, timestamp = null) {
+  messageDiv.querySelector(".message-content").innerHTML = `
+            ${formatMessage(content)}
+            ${timestamp ? `<div class="message-timestamp">${formatTimestamp(timestamp)}</div>` : ""}
+        `;
+  scrollToBottom();
 }
 
 // Format message content (handle markdown, code blocks, etc.)
@@ -2,67 +2,100 @@
 """
 Test script to verify that the debug feature (inner workings) is working correctly.
 This tests that the API returns the last_prompt field with the full prompt sent to the LLM.
+With --concurrency N it sends N messages at once from separate sessions, which also
+exercises the server's request scheduling under load.
 """
 
+import argparse
+import asyncio
 import json
 import sys
+import time
 
-import requests
+import httpx
 
+# API endpoint
+BASE_URL = "http://localhost:8000"
 
-def test_debug_feature():
-    """Test that the chat API returns the last_prompt field"""
+# Seconds to wait for a response; concurrent requests queue on the server
+REQUEST_TIMEOUT = 300
+
+# Test message
+TEST_MESSAGE = "Hello, can you explain what artificial intelligence is in simple terms?"
 
-    # API endpoint
-    base_url = "http://localhost:8000"
-    chat_endpoint = f"{base_url}/api/chat"
 
-    # Test message
-    test_message = (
-        "Hello, can you explain what artificial intelligence is in simple terms?"
+async def send_message(client, message):
+    """Send one message in a new session, returning the response and its latency"""
+    start = time.perf_counter()
+    response = await client.post(
+        "/api/chat",
+        json={
+            "message": message,
+            "session_id": None,  # Will create a new session
+        },
     )
+    return response, time.perf_counter() - start
+
+
+async def send_messages(message, concurrency):
+    """Send the message concurrently from the given number of new sessions"""
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=REQUEST_TIMEOUT) as client:
+        return await asyncio.gather(
+            *[send_message(client, message) for _ in range(concurrency)]
+        )
+
+
+def test_debug_feature(concurrency=1):
+    """Test that the chat API returns the last_prompt field"""
+
+    test_message = TEST_MESSAGE
 
     print("=" * 60)
     print("Testing Debug Feature - Inner Workings")
     print("=" * 60)
     print()
 
-    # Prepare the request
-    payload = {
-        "message": test_message,
-        "session_id": None,  # Will create a new session
-    }
-
     print(f"Sending message: {test_message}")
+    if concurrency > 1:
+        print(f"Concurrent requests: {concurrency}")
     print()
 
     try:
-        # Send the request
-        response = requests.post(
-            chat_endpoint, json=payload, headers={"Content-Type": "application/json"}
-        )
-
-        # Check if request was successful
-        if response.status_code != 200:
-            print(f"❌ Error: API returned status code {response.status_code}")
-            print(f"Response: {response.text}")
-            return False
+        # Send the requests
+        start = time.perf_counter()
+        results = asyncio.run(send_messages(test_message, concurrency))
+        elapsed = time.perf_counter() - start
+
+        # Check if all requests were successful
+        for response, _ in results:
+            if response.status_code != 200:
+                print(f"❌ Error: API returned status code {response.status_code}")
+                print(f"Response: {response.text}")
+                return False
 
-        # Parse the response
-        data = response.json()
+        # Parse the responses
+        all_data = [response.json() for response, _ in results]
 
-        # Check if response has required fields
+        # Check if responses have required fields
         required_fields = ["response", "session_id", "timestamp"]
-        for field in required_fields:
-            if field not in data:
-                print(f"❌ Error: Missing required field '{field}' in response")
-                return False
+        for data in all_data:
+            for field in required_fields:
+                if field not in data:
+                    print(f"❌ Error: Missing required field '{field}' in response")
+                    return False
+
+        if len({data["session_id"] for data in all_data}) != len(all_data):
+            print("❌ Error: Concurrent requests were given the same session")
+            return False
+
+        # The remaining checks look at the first response in detail
+        data = all_data[0]
 
         print("✅ All required fields present in response")
         print()
 
         # Check if last_prompt field exists
-        if "last_prompt" not in data:
+        if any("last_prompt" not in data for data in all_data):
             print("❌ Error: 'last_prompt' field is missing from response")
             print("The debug feature may not be properly implemented")
             return False
@@ -88,7 +121,7 @@ def test_debug_feature():
             print("⚠️  Warning: System prompt may be missing")
 
         # Check for user message
-        if test_message in last_prompt:
+        if all(test_message in data["last_prompt"] for data in all_data):
             print("✅ User message found in the full prompt")
         else:
             print("❌ Error: User message not found in the full prompt")
@@ -102,6 +135,15 @@ def test_debug_feature():
                 "ℹ️  Note: Gemma conversation markers not found (model may use different format)"
             )
 
+        if concurrency > 1:
+            latencies = sorted(latency for _, latency in results)
+            print()
+            print(f"✅ All {concurrency} concurrent requests succeeded")
+            print(f"   Total time:     {elapsed:.2f}s")
+            print(f"   Fastest:        {latencies[0]:.2f}s")
+            print(f"   Median latency: {latencies[len(latencies) // 2]:.2f}s")
+            print(f"   Slowest:        {latencies[-1]:.2f}s")
+
         print()
         print("=" * 60)
         print("TEST SUMMARY:")
@@ -124,12 +166,12 @@ def test_debug_feature():
 
         return True
 
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print("❌ Error: Could not connect to the server")
-        print("Make sure the server is running on http://localhost:8000")
+        print(f"Make sure the server is running on {BASE_URL}")
         print("Run: python server.py")
         return False
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Error: Request failed - {e}")
         return False
     except json.JSONDecodeError:
@@ -140,15 +182,32 @@ def test_debug_feature():
         return False
 
 
+def positive_int(value):
+    """Parse a command line value that must be a whole number of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=1,
+        help="number of messages to send at the same time (default: 1)",
+    )
+    args = parser.parse_args()
+
     print()
     print("This script tests the 'Inner Workings' debug feature")
     print("It verifies that the API returns the last prompt sent to the LLM")
     print()
 
     # Run the test
-    success = test_debug_feature()
+    success = test_debug_feature(concurrency=args.concurrency)
 
     # Exit with appropriate code
     sys.exit(0 if success else 1)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Test script to verify that loading the model with int8 weight quantization keeps its quality.
+This compares the perplexity of the full-precision and the quantized model on a fixed prompt.
+"""
+
+import math
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import ModelRuntime
+
+MODEL_NAME = "google/gemma-3-270m-it"
+
+# Largest accepted relative perplexity increase of the quantized model
+MAX_PERPLEXITY_INCREASE = 0.05
+
+TEST_TEXT = (
+    "<start_of_turn>user\n"
+    "Tell me, in a few words, how to compute all prime numbers up to 1000?"
+    "<end_of_turn>\n"
+    "<start_of_turn>model\n"
+    "Use the Sieve of Eratosthenes: list the numbers from 2 to 1000, then "
+    "repeatedly take the smallest remaining number and cross out its multiples. "
+    "The numbers left at the end are the primes."
+    "<end_of_turn>\n"
+)
+
+
+def compute_perplexity(runtime, text):
+    """Compute the perplexity of the runtime's model on the given text"""
+    input_ids = runtime.tokenize(text, add_special_tokens=True)
+    with torch.no_grad():
+        loss = runtime.model(input_ids=input_ids, labels=input_ids).loss
+    return math.exp(loss.item())
+
+
+def test_quantization_perplexity():
+    """Test that the quantized model's perplexity stays close to full precision"""
+
+    print("=" * 60)
+    print("Testing Quantization - Perplexity")
+    print("=" * 60)
+    print()
+
+    try:
+        print("Loading full-precision model...")
+        baseline = compute_perplexity(
+            ModelRuntime(model_name=MODEL_NAME, quantize=False), TEST_TEXT
+        )
+
+        print("Loading int8 quantized model...")
+        quantized = compute_perplexity(
+            ModelRuntime(model_name=MODEL_NAME, quantize=True), TEST_TEXT
+        )
+    except Exception as e:
+        print(f"❌ Unexpected error: {e}")
+        return False
+
+    increase = quantized / baseline - 1
+    print()
+    print(f"Full-precision perplexity: {baseline:.3f}")
+    print(f"Quantized perplexity:      {quantized:.3f}")
+    print(f"Relative increase:         {increase:+.2%}")
+    print()
+
+    if increase > MAX_PERPLEXITY_INCREASE:
+        print(
+            f"❌ Error: Perplexity increased by more than {MAX_PERPLEXITY_INCREASE:.0%}"
+        )
+        return False
+
+    print("✅ Quantized model perplexity is within the accepted range")
+    return True
+
+
+def main():
+    """Main function"""
+    print()
+    print("This script tests the int8 weight quantization of the model")
+    print("It verifies that quantization does not noticeably raise perplexity")
+    print()
+
+    # Run the test
+    success = test_quantization_perplexity()
+
+    # Exit with appropriate code
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()